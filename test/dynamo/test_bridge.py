@@ -50,6 +50,34 @@ class LinearModule(nn.Module):
     return (torch.randn(2, 10),)
 
 
+class FunctionalLinearModule(nn.Module):
+
+  def __init__(self):
+    super().__init__()
+    self.weight = nn.Parameter(torch.randn(5, 10))
+    self.bias = nn.Parameter(torch.randn(5))
+
+  def forward(self, x):
+    return nn.functional.linear(x, self.weight, self.bias)
+
+  def get_random_inputs(self):
+    return (torch.randn(2, 10),)
+
+
+class DropoutModule(nn.Module):
+
+  def __init__(self):
+    super().__init__()
+    self.linear = nn.Linear(10, 5)
+    self.dropout = nn.Dropout(0.5)
+
+  def forward(self, x):
+    return self.dropout(self.linear(x))
+
+  def get_random_inputs(self):
+    return (torch.randn(2, 10),)
+
+
 class MaxPoolModule(nn.Module):
 
   def __init__(self):
@@ -91,6 +119,27 @@ class UpsampleModule(nn.Module):
     return (torch.randn((1, 1, 5)),)
 
 
+def split_to_cpu(x):
+  return {'xla': x + 1, 'cpu': x.cpu()}
+
+
+# Keep `split_to_cpu` as a single node when tracing.
+fx.wrap('split_to_cpu')
+
+
+class DictOutputModule(nn.Module):
+
+  def __init__(self):
+    super().__init__()
+
+  def forward(self, x):
+    out = split_to_cpu(x)
+    return out['xla']
+
+  def get_random_inputs(self):
+    return (torch.randn(10),)
+
+
 def allclose(expected, actual):
 
   def unwrap(cont):
@@ -222,6 +271,55 @@ class TorchXLAReuseGraphTest(torch._dynamo.test_case.TestCase):
   test_training_maxpool = make_training_test(MaxPoolModule)
   test_training_upsample = make_training_test(UpsampleModule)
 
+  def test_extract_compiled_graph_cache(self):
+    xla_dev = xm.xla_device()
+    xla_module = FunctionalLinearModule().to(device=xla_dev)
+    inputs = tuple(x.to(device=xla_dev) for x in xla_module.get_random_inputs())
+    metrics.clear_counters()
+    optimized_mod = bridge.extract_compiled_graph(
+        fx.symbolic_trace(xla_module), inputs)
+    # Same graph structure, parameters and input metadata.
+    cached_mod = bridge.extract_compiled_graph(
+        fx.symbolic_trace(xla_module), inputs)
+    self.assertIs(optimized_mod, cached_mod)
+    self.assertEqual(metrics.counter_value('DynamoCompiledGraphCacheHit'), 1)
+
+    # A different module instance has different parameters.
+    other_module = FunctionalLinearModule().to(device=xla_dev)
+    other_mod = bridge.extract_compiled_graph(
+        fx.symbolic_trace(other_module), inputs)
+    self.assertIsNot(optimized_mod, other_mod)
+    self.assertTrue(allclose(other_module(*inputs), other_mod(*inputs)))
+
+    # Clearing the cache drops the cached graphs.
+    bridge.clear_compiled_graph_cache()
+    cleared_mod = bridge.extract_compiled_graph(
+        fx.symbolic_trace(xla_module), inputs)
+    self.assertIsNot(optimized_mod, cleared_mod)
+
+  def test_extract_compiled_graph_cache_module_state(self):
+    xla_dev = xm.xla_device()
+    xla_module = DropoutModule().to(device=xla_dev)
+    inputs = tuple(x.to(device=xla_dev) for x in xla_module.get_random_inputs())
+    train_mod = bridge.extract_compiled_graph(
+        fx.symbolic_trace(xla_module), inputs)
+    # The graph code and parameters are unchanged, but dropout is now disabled.
+    xla_module.eval()
+    eval_mod = bridge.extract_compiled_graph(
+        fx.symbolic_trace(xla_module), inputs)
+    self.assertIsNot(train_mod, eval_mod)
+    self.assertTrue(allclose(xla_module(*inputs), eval_mod(*inputs)))
+
+  def test_unsupported_nodes_in_dict(self):
+    xla_dev = xm.xla_device()
+    xla_module = DictOutputModule()
+    inputs = tuple(x.to(device=xla_dev) for x in xla_module.get_random_inputs())
+    collector = bridge.UnsupportedNodesCollector(fx.symbolic_trace(xla_module))
+    collector.run(*inputs)
+    unsupported_nodes = [n.name for n in collector.get_unsupported_nodes()]
+    # A CPU tensor in the returned dict, and then in the dict argument.
+    self.assertEqual(unsupported_nodes, ['split_to_cpu', 'getitem'])
+
   def _compile_and_check(self, fn, args, backend="openxla"):
     r = fn(*args)
     xm.mark_step()
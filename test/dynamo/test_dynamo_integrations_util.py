@@ -41,6 +41,25 @@ class PybindTest(unittest.TestCase):
     ])
     assert (expected_tensor_ids == sorted(res_pair[0]))
 
+  def test_get_tensor_ids(self):
+    xla_device = xm.xla_device()
+    t1 = torch.randn(20, 5).to(xla_device)
+    t2 = torch.randn(20, 5).to(xla_device)
+    t3 = t2 + t1
+    tensors = [t1, t2, t3, t1]
+    self.assertEqual(
+        torch_xla._XLAC._xla_get_tensor_ids(tensors),
+        [torch_xla._XLAC._xla_get_tensor_id(t) for t in tensors])
+    self.assertEqual(torch_xla._XLAC._xla_get_tensor_ids([]), [])
+
+  def test_all_tensors_on_xla_device(self):
+    xla_device = xm.xla_device()
+    t1 = torch.randn(20, 5).to(xla_device)
+    t2 = torch.randn(20, 5)
+    self.assertTrue(torch_xla._XLAC._xla_all_tensors_on_xla_device([t1, t1]))
+    self.assertTrue(torch_xla._XLAC._xla_all_tensors_on_xla_device([]))
+    self.assertFalse(torch_xla._XLAC._xla_all_tensors_on_xla_device([t1, t2]))
+
   def test_get_base_seed_as_tensor(self):
     device = xm.xla_device()
     xm.set_rng_state(23, str(device))
@@ -103,6 +122,23 @@ class PybindTest(unittest.TestCase):
     # mark_step should not incur new execution
     self.assertEqual(met.metric_data('ExecuteTime')[0], 1)
 
+  def test_batch_copy(self):
+    xla_device = xm.xla_device()
+    dests = [
+        torch.zeros(20, 5, device=xla_device),
+        torch.zeros(10, device=xla_device)
+    ]
+    srcs = [
+        torch.randn(20, 5, device=xla_device),
+        torch.randn(10, device=xla_device)
+    ]
+    torch_xla._XLAC._xla_batch_copy_(dests, srcs)
+    for dest, src in zip(dests, srcs):
+      self.assertTrue(torch.equal(dest.cpu(), src.cpu()))
+    # Every dest needs a src.
+    with self.assertRaises(RuntimeError):
+      torch_xla._XLAC._xla_batch_copy_(dests, srcs[:1])
+
   def test_run_cached_graph(self):
     xla_device = xm.xla_device()
     xla_input = torch.randn(64, 256, 14, 14).to(xla_device)
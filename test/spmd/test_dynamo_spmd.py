@@ -141,6 +141,25 @@ class DynamoSpmdInferenceTest(test_xla_sharding_base.XlaShardingTest):
       self.assertEqual(met.metric_data('CompileTime')[0], 1)
     torch.allclose(linear(xla_y).cpu(), dynamo_res_sharded_2.cpu())
 
+  def test_get_xla_sharding_specs_hash(self):
+    device = xm.xla_device()
+    mesh = self._get_mesh((1, self.n_devices))
+    xla_x = torch.randn(8, 8, device=device)
+    xla_y = torch.randn(8, 8, device=device)
+    xs.mark_sharding(xla_x, mesh, (0, 1))
+    xs.mark_sharding(xla_y, mesh, (0, 1))
+    specs_hash = torch_xla._XLAC._get_xla_sharding_specs_hash
+    # Identical shardings have the same hash.
+    self.assertEqual(specs_hash([xla_x]), specs_hash([xla_y]))
+    sharded_hash = specs_hash([xla_x, xla_y])
+    self.assertEqual(sharded_hash, specs_hash([xla_x, xla_y]))
+
+    xs.clear_sharding(xla_y)
+    self.assertNotEqual(specs_hash([xla_x]), specs_hash([xla_y]))
+    self.assertNotEqual(sharded_hash, specs_hash([xla_x, xla_y]))
+    xs.clear_sharding(xla_x)
+    self.assertEqual(specs_hash([xla_x]), specs_hash([xla_y]))
+
   @unittest.skipIf(xr.global_runtime_device_count() == 1,
                    "Multiple devices needed to test the mesh change")
   def test_dynamo_input_sharding_threashold(self):
@@ -1,17 +1,17 @@
+import collections
 import copy
-import dataclasses
 import operator
 import warnings
+import weakref
 
 import functools
 import itertools
 import os
-import time
 from typing import Any, Dict, List, Set, Tuple
 from contextlib import contextmanager
 
 import torch
-from torch.fx.passes.infra.partitioner import CapabilityBasedPartitioner
+from torch.fx.passes.infra.partitioner import CapabilityBasedPartitioner, Partition
 from torch.fx.passes.utils.fuser_utils import topo_sort
 
 import torch._inductor
@@ -27,6 +27,7 @@ import torch_xla.utils.utils as xu
 
 dynamo_debug = int(os.environ.get('XLA_DYNAMO_DEBUG', '0')) == 1
 ptxla_debug = int(os.environ.get('PT_XLA_DEBUG', '0')) == 1
+functionalization_disabled = xu.check_env_flag('XLA_DISABLE_FUNCTIONALIZATION')
 
 
 @contextmanager
@@ -40,7 +41,6 @@ def alias_with_buffer_donor_config(should_alias: bool = True):
     torch_xla._XLAC._xla_set_should_alias_with_buffer_donor_config(saved_config)
 
 
-@dataclasses.dataclass
 class GraphInputMatcher:
   """
   The GraphInputMatcher class setup the graph inputs for future calls after lazy tracing.
@@ -55,6 +55,14 @@ class GraphInputMatcher:
     xla_args_tensor_id: Set[int] - A set of tensor_ids for FX Graph inputs.
   """
 
+  __slots__ = ('tensor_id_to_arg_idx', 'graph_input_tensor_ids',
+               'graph_input_xla_values', '_plan')
+
+  # Kinds of graph input sources recorded in `_plan`.
+  _SEED = 0
+  _CONST = 1
+  _ARG = 2
+
   def __init__(self, tensor_id_to_arg_idx: Dict[int, int],
                graph_input_tensor_ids: List[int],
                graph_input_xla_values: List[torch.tensor],
@@ -72,30 +80,43 @@ class GraphInputMatcher:
         None if tensor_id in xla_args_tensor_id else xla_value for tensor_id,
         xla_value in zip(graph_input_tensor_ids, graph_input_xla_values)
     ]
-
-  # get the real graph input tensors
-  def __call__(self, args):
-    real_input = []
+    # Resolve the source of every graph input once so that `__call__` does not
+    # need to redo the dict lookups and seed id checks on each run. Each plan
+    # entry is a (kind, payload) tuple where payload is the traced device
+    # string for _SEED, the cached tensor for _CONST and the index into the
+    # call arguments for _ARG.
+    seed_info_id = torch_xla._XLAC._get_seed_info_id()
+    self._plan = []
     for tensor_id, traced_xla_value in zip(self.graph_input_tensor_ids,
                                            self.graph_input_xla_values):
       arg_idx = self.tensor_id_to_arg_idx.get(tensor_id, None)
       # Instead of use trace time base seed, use the runtime
       # base seed here.
-      if tensor_id == torch_xla._XLAC._get_seed_info_id():
-        str_device = str(traced_xla_value.device)
-        inp = torch_xla._XLAC._get_base_seed_as_tensor(str_device)
-        # update random seed here to avoid random operations always return
-        # the same result. The seed update logic is the same as `mark_step` in
-        # https://github.com/pytorch/pytorch/blob/6af6b8f728426fb7551630e28148c0017fa501bc/torch/csrc/lazy/core/lazy_graph_executor.cpp#L144C18-L144C51
-        xm.set_rng_state(
-            (1012031 + inp.item() * 7012063) % 18446744073709551615, str_device)
+      if tensor_id == seed_info_id:
+        self._plan.append((self._SEED, str(traced_xla_value.device)))
       elif arg_idx is None:
         assert traced_xla_value is not None, "Traced Tensor cannot be None."
-        inp = traced_xla_value
+        self._plan.append((self._CONST, traced_xla_value))
       else:
         assert traced_xla_value is None, "Graph input tensor should not be cached."
-        inp = args[arg_idx]
-      real_input.append(inp)
+        self._plan.append((self._ARG, arg_idx))
+
+  # get the real graph input tensors
+  def __call__(self, args):
+    real_input = [None] * len(self._plan)
+    for i, (kind, payload) in enumerate(self._plan):
+      if kind == self._ARG:
+        real_input[i] = args[payload]
+      elif kind == self._CONST:
+        real_input[i] = payload
+      else:
+        inp = torch_xla._XLAC._get_base_seed_as_tensor(payload)
+        # update random seed here to avoid random operations always return
+        # the same result. The seed update logic is the same as `mark_step` in
+        # https://github.com/pytorch/pytorch/blob/6af6b8f728426fb7551630e28148c0017fa501bc/torch/csrc/lazy/core/lazy_graph_executor.cpp#L144C18-L144C51
+        xm.set_rng_state(
+            (1012031 + inp.item() * 7012063) % 18446744073709551615, payload)
+        real_input[i] = inp
     return real_input
 
 
@@ -135,37 +156,49 @@ def _maybe_move_tensors_to_device(tensors: tuple,
   if not torch.cuda.is_available():
     return tensors
 
-  moved_tensors = []
-  cpu_device: torch.device = torch.device("cpu")
-
-  for tensor in tensors:
-    if not isinstance(tensor, torch.Tensor):
-      moved_tensors.append(tensor)
-      continue
-
-    if tensor.device == target_device:
-      moved_tensors.append(tensor)
-      continue
-
-    assert target_device is not None, "Moving tensors to None device not supported"
+  assert target_device is not None, "Moving tensors to None device not supported"
 
+  positions_to_move = [
+      i for i, tensor in enumerate(tensors)
+      if isinstance(tensor, torch.Tensor) and tensor.device != target_device
+  ]
+  if not positions_to_move:
+    return tuple(tensors)
+
+  # Fetch all of the XLA tensors to CPU with a single batched transfer instead
+  # of syncing the device once per tensor.
+  xla_positions = [i for i in positions_to_move if is_xla_tensor(tensors[i])]
+  cpu_tensors = dict(
+      zip(
+          xla_positions,
+          torch_xla._XLAC._xla_get_cpu_tensors(
+              [tensors[i] for i in xla_positions])))
+
+  moved_tensors = list(tensors)
+  cpu_device: torch.device = torch.device("cpu")
+  for i in positions_to_move:
+    tensor = tensors[i]
     if dynamo_debug:
       print("Moving Tensor {} to device {}".format(tensor, target_device))
 
     # Have to move to CPU before moving it to target device.
-    moved_tensor = tensor.to(cpu_device)
-    moved_tensor = moved_tensor.to(target_device)
+    if i in cpu_tensors:
+      moved_tensor = cpu_tensors[i].to(target_device)
+    else:
+      moved_tensor = tensor.to(cpu_device).to(target_device)
 
     # Explicitly have to copy requires_grad attribute because it's dropped
     # with torch.to(..)
     moved_tensor.requires_grad = tensor.requires_grad
-    moved_tensors.append(moved_tensor)
+    moved_tensors[i] = moved_tensor
 
   return tuple(moved_tensors)
 
 
 class Deduper:
 
+  __slots__ = ('permute_for_orig',)
+
   def __init__(self):
     # origlist index to dedupedlist index
     self.permute_for_orig = None
@@ -175,18 +208,14 @@ class Deduper:
     deduped_ids = dict()
     deduped_list = []
     for item in origlist:
-      item_id = id(item)
-      if item_id not in deduped_ids:
-        deduped_ids[item_id] = len(deduped_ids)
+      # a single dict probe both looks up and assigns the deduped index
+      deduped_idx = deduped_ids.setdefault(id(item), len(deduped_list))
+      if deduped_idx == len(deduped_list):
         deduped_list.append(item)
-      self.permute_for_orig.append(deduped_ids[item_id])
+      self.permute_for_orig.append(deduped_idx)
 
     return deduped_list
 
-  def recover(self, deduped_list):
-    assert len(self.permute_for_orig) >= len(deduped_list)
-    return [deduped_list[i] for i in self.permute_for_orig]
-
 
 class DumbReturnHandler:
   """
@@ -207,6 +236,10 @@ class DumbReturnHandler:
   the contract with the caller.
   """
 
+  __slots__ = ('trace_inputs', 'trace_outputs', 'deduper',
+               'deduped_trace_outputs', 'trace_outputs_pos_to_inputs_pos',
+               'num_real_outputs', 'output_plan')
+
   def __init__(self, trace_inputs, trace_outputs,
                trace_inputs_inplace_update_bool):
     self.trace_inputs = trace_inputs
@@ -220,22 +253,34 @@ class DumbReturnHandler:
     trace_inputs_id2pos = {
         id(x): pos for pos, x in enumerate(self.trace_inputs)
     }
-    self.trace_outputs_pos_to_inputs_pos = []
-    for out_pos, out in enumerate(self.deduped_trace_outputs):
-      in_pos = trace_inputs_id2pos.get(id(out), None)
-      if in_pos is not None and not trace_inputs_inplace_update_bool[in_pos]:
-        self.trace_outputs_pos_to_inputs_pos.append((out_pos, in_pos))
-
-  def addDumbReturn(self, real_inputs, real_outputs):
-    for out_pos, in_pos in self.trace_outputs_pos_to_inputs_pos:
-      assert in_pos < len(real_inputs)
-      # equals is fine since we can append an item at the end
-      assert out_pos <= len(real_outputs)
+    self.trace_outputs_pos_to_inputs_pos = [
+        (out_pos, in_pos)
+        for out_pos, out in enumerate(self.deduped_trace_outputs)
+        if (in_pos := trace_inputs_id2pos.get(id(out))) is not None and
+        not trace_inputs_inplace_update_bool[in_pos]
+    ]
 
-      real_outputs.insert(out_pos, real_inputs[in_pos])
+    # Precompute where every original output comes from, so that adding the
+    # dumb returns and recovering the duplications is a single pass. Each
+    # entry is (from_inputs, index): an index into real_inputs if from_inputs
+    # is True, otherwise an index into the real outputs of the graph.
+    out_pos_to_in_pos = dict(self.trace_outputs_pos_to_inputs_pos)
+    deduped_plan = []
+    self.num_real_outputs = 0
+    for out_pos in range(len(self.deduped_trace_outputs)):
+      if out_pos in out_pos_to_in_pos:
+        deduped_plan.append((True, out_pos_to_in_pos[out_pos]))
+      else:
+        deduped_plan.append((False, self.num_real_outputs))
+        self.num_real_outputs += 1
+    self.output_plan = [deduped_plan[i] for i in self.deduper.permute_for_orig]
 
-    ret = self.deduper.recover(real_outputs)
-    return ret
+  def addDumbReturn(self, real_inputs, real_outputs):
+    assert len(real_outputs) == self.num_real_outputs
+    return [
+        real_inputs[index] if from_inputs else real_outputs[index]
+        for from_inputs, index in self.output_plan
+    ]
 
 
 class NoneRemover:
@@ -247,31 +292,42 @@ class NoneRemover:
   compiled graph from torchxla.
   """
 
+  __slots__ = ('none_poslist', 'value_poslist')
+
   def __init__(self):
     self.none_poslist = []
+    # original position of every non-None value, in order
+    self.value_poslist = []
 
   def remove_nones(self, value_list):
     """
     Remove none from value_list. value_list will be inplace updated.
     The original position of None values are recorded.
     """
-    num = len(value_list)
-
-    # work in reverse order
-    for i in reversed(range(num)):
-      if value_list[i] is None:
+    self.none_poslist = []
+    self.value_poslist = []
+    for i, value in enumerate(value_list):
+      if value is None:
         self.none_poslist.append(i)
-        del value_list[i]
+      else:
+        self.value_poslist.append(i)
 
-    self.none_poslist.reverse()
+    if self.none_poslist:
+      value_list[:] = [value for value in value_list if value is not None]
 
   def add_nones(self, value_list):
     """
     Add nones to value_list according to self.none_poslist. value_list
     is inplace updated.
     """
-    for pos in self.none_poslist:
-      value_list.insert(pos, None)
+    if not self.none_poslist:
+      return
+
+    assert len(value_list) == len(self.value_poslist)
+    filled = [None] * (len(self.none_poslist) + len(self.value_poslist))
+    for pos, value in zip(self.value_poslist, value_list):
+      filled[pos] = value
+    value_list[:] = filled
 
 
 def is_xla_tensor(tensor: torch.Tensor) -> bool:
@@ -281,19 +337,8 @@ def is_xla_tensor(tensor: torch.Tensor) -> bool:
 def extract_graph_helper(xla_model: torch.fx.GraphModule):
   # FX Graph inputs passed from Dynamo. xla_args are XLA Tensors.
   xla_args = xla_model.xla_args
-  xla_args_tensor_ids = set(
-      pytree.tree_map_only(
-          torch.Tensor,
-          lambda xla_arg: torch_xla._XLAC._xla_get_tensor_id(xla_arg),
-          xla_args))
-  assert all(
-      map(
-          is_xla_tensor,
-          filter(
-              lambda x: isinstance(x, torch.Tensor),
-              itertools.chain(xla_model.parameters(), xla_args),
-          ),
-      )), "All tensors should be on xla"
+  assert all(map(is_xla_tensor,
+                 xla_model.parameters())), "All tensors should be on xla"
 
   # Clone the input tensors which can be used to restore the origional value of the xla_args
   # if model applied inplace operations to the input.
@@ -303,29 +348,41 @@ def extract_graph_helper(xla_model: torch.fx.GraphModule):
   # TensorID in `_get_tensors_xla_device_data_node` to create the mapping, the wrong Tensor ID
   # will be returned.
   # TODO(JackCaoG): fix the cloned tensor can't be used to warm up the cache.
-  cloned_xla_args = [
-      torch.clone(xla_arg) if isinstance(xla_arg, torch.Tensor) else xla_arg
-      for xla_arg in xla_args
-  ]
-
-  index_and_xla_tensor_args = [(i, xla_arg)
-                               for i, xla_arg in enumerate(xla_args)
-                               if isinstance(xla_arg, torch.Tensor)]
-
-  index_and_tensor_ids = [(index, torch_xla._XLAC._xla_get_tensor_id(xla_arg))
-                          for index, xla_arg in index_and_xla_tensor_args]
+  #
+  # The tensor args are collected, checked and cloned in a single sweep.
+  index_and_xla_tensor_args = []
+  xla_tensor_args = []
+  cloned_xla_tensor_args = []
+  for i, xla_arg in enumerate(xla_args):
+    if isinstance(xla_arg, torch.Tensor):
+      assert is_xla_tensor(xla_arg), "All tensors should be on xla"
+      index_and_xla_tensor_args.append((i, xla_arg))
+      xla_tensor_args.append(xla_arg)
+      cloned_xla_tensor_args.append(torch.clone(xla_arg))
+
+  # Positions of the tensor args are invariant for a given graph, record them
+  # so that `optimized_mod` does not need to rescan the args on every call.
+  tensor_arg_positions = tuple(index for index, _ in index_and_xla_tensor_args)
+
+  # Fetch all of the tensor ids with a single pybind call.
+  xla_args_tensor_id_list = torch_xla._XLAC._xla_get_tensor_ids(xla_tensor_args)
+  xla_args_tensor_ids = set(xla_args_tensor_id_list)
 
   if dynamo_debug:
     print(f"Graph Module:\n{xla_model.code}")
 
   tensor_id_to_arg_idx = {
-      tensor_id: index for index, tensor_id in index_and_tensor_ids
+      tensor_id: index
+      for index, tensor_id in zip(tensor_arg_positions, xla_args_tensor_id_list)
   }
 
+  # Only a digest of the input shardings is kept, `optimized_mod` just needs to
+  # detect whether they changed.
   if xr.is_spmd():
-    xla_args_sharding_spec = torch_xla._XLAC._get_xla_sharding_specs(xla_args)
+    xla_args_sharding_hash = torch_xla._XLAC._get_xla_sharding_specs_hash(
+        xla_args)
   else:
-    xla_args_sharding_spec = ()
+    xla_args_sharding_hash = None
 
   xla_out = xla_model(*xla_args)
   if not isinstance(xla_out, (tuple, list)):
@@ -338,7 +395,13 @@ def extract_graph_helper(xla_model: torch.fx.GraphModule):
 
   # If a arg is being in place updated by model, we need to include arg as part of the graph result.
   xla_args_need_update_bool = torch_xla._XLAC._check_tensor_need_materialization(
-      [tensor for _, tensor in index_and_xla_tensor_args])
+      xla_tensor_args)
+  # Only the clones of the in place updated args are needed for the restore
+  # below, drop the others so they are no longer live tensors.
+  cloned_xla_tensor_args = {
+      i: cloned for i, (cloned, need_update) in enumerate(
+          zip(cloned_xla_tensor_args, xla_args_need_update_bool)) if need_update
+  }
   xla_args_need_update = []
   arg_index_to_need_update_index = {}
   for i, need_update in enumerate(xla_args_need_update_bool):
@@ -396,9 +459,8 @@ def extract_graph_helper(xla_model: torch.fx.GraphModule):
   # in place update will replace the underlying DeviceData of the `xla_args`.
   # Note that this needs to happens before `_clear_pending_irs` otherwise
   # the additional IR generated by `copy_` won't be cleared.
-  for i, need_update in enumerate(xla_args_need_update_bool):
-    if need_update and isinstance(xla_args[i], torch.Tensor):
-      xla_args[i].copy_(cloned_xla_args[i])
+  for i, cloned in cloned_xla_tensor_args.items():
+    xla_tensor_args[i].copy_(cloned)
 
   # Remove all of the pending IR from all live tensors. The assumptions are
   # 1. With the  `xm.mark_step` in the beginning of this call, every XLATensor
@@ -406,10 +468,10 @@ def extract_graph_helper(xla_model: torch.fx.GraphModule):
   # 2. All of the pending IRs are result of our warm up cache tracing and they
   # should be removed to avoid extra computation executed and in place updates op
   # mistakenlly update the input tensors.
-  torch_xla._XLAC._clear_pending_irs(str(xm.xla_device()))
-  return (xla_args_sharding_spec, args_and_out, graph_hash,
+  torch_xla._XLAC._clear_pending_irs(torch_xla._XLAC._xla_get_default_device())
+  return (xla_args_sharding_hash, args_and_out, graph_hash,
           arg_index_to_need_update_index, none_remover, graph_input_matcher,
-          dumb_return_handler, xla_args_need_update)
+          dumb_return_handler, xla_args_need_update, tensor_arg_positions)
 
 
 def extract_internal(xla_model: torch.fx.GraphModule):
@@ -423,15 +485,22 @@ def extract_internal(xla_model: torch.fx.GraphModule):
         print(torch_xla._XLAC._get_xla_tensor_debug_info(xla_arg))
   # Don't reset the scope as we might be under some profiler trace scope.
   xm.mark_step(reset_scope=False)
-  (xla_args_sharding_spec, args_and_out, graph_hash,
+  (xla_args_sharding_hash, args_and_out, graph_hash,
    arg_index_to_need_update_index, none_remover, graph_input_matcher,
-   dumb_return_handler, xla_args_need_update) = extract_graph_helper(xla_model)
-  skip_checking_input_sharding_threashold = xu.getenv_as(
+   dumb_return_handler, xla_args_need_update,
+   tensor_arg_positions) = extract_graph_helper(xla_model)
+  # Read at compile time rather than import time so that it can still be
+  # configured per compiled graph.
+  input_sharding_check_threshold = xu.getenv_as(
       'XLA_DYNAMO_INPUT_SHARDING_CHECK_THRESHOLD', int, 5)
+  skip_checking_input_sharding_threashold = input_sharding_check_threshold
+  # SPMD mode can not be toggled once enabled, resolve it here instead of on
+  # every call of `optimized_mod`.
+  is_spmd = xr.is_spmd()
 
   def optimized_mod(*args: tuple):
     nonlocal xla_model
-    nonlocal xla_args_sharding_spec
+    nonlocal xla_args_sharding_hash
     nonlocal args_and_out
     nonlocal graph_hash
     nonlocal arg_index_to_need_update_index
@@ -439,6 +508,7 @@ def extract_internal(xla_model: torch.fx.GraphModule):
     nonlocal graph_input_matcher
     nonlocal dumb_return_handler
     nonlocal xla_args_need_update
+    nonlocal tensor_arg_positions
     nonlocal skip_checking_input_sharding_threashold
 
     original_device: torch.device = _get_input_arg_device(args)
@@ -451,50 +521,51 @@ def extract_internal(xla_model: torch.fx.GraphModule):
 
     # mark_step needs to be blocking since we want to access args's XLADatas
     # and they can't be placeholder.
-    input_tensors_to_sync = [
-        args[i] for i, x in enumerate(
-            torch_xla._XLAC._check_tensor_need_materialization(
-                [a for a in args if isinstance(a, torch.Tensor)])) if x
-    ]
-    if len(input_tensors_to_sync) > 0:
-      torch_xla._XLAC._xla_increment_counter('DynamoSyncInputExecuteTime', 1)
-      torch_xla._XLAC._xla_sync_multi(
-          input_tensors_to_sync, devices=[], wait=True, sync_xla_data=True)
+    if tensor_arg_positions:
+      tensor_args = [args[i] for i in tensor_arg_positions]
+      input_tensors_to_sync = [
+          tensor_args[i]
+          for i, x in enumerate(
+              torch_xla._XLAC._check_tensor_need_materialization(tensor_args))
+          if x
+      ]
+      if len(input_tensors_to_sync) > 0:
+        torch_xla._XLAC._xla_increment_counter('DynamoSyncInputExecuteTime', 1)
+        torch_xla._XLAC._xla_sync_multi(
+            input_tensors_to_sync, devices=[], wait=True, sync_xla_data=True)
 
     # If input sharding has changed from the previous program, dynamo current can
     # not detect this. It will mistakenly believe the program is the same. We need
     # to retrace it here.
-    if xr.is_spmd():
+    if is_spmd:
       # if the input sharding was the same for skip_checking_input_sharding_threashold times
       # we will skip checking the input sharding since it can be expensive.
       if skip_checking_input_sharding_threashold > 0:
-        if torch_xla._XLAC._get_xla_sharding_specs(
-            args) != xla_args_sharding_spec:
+        if torch_xla._XLAC._get_xla_sharding_specs_hash(
+            args) != xla_args_sharding_hash:
           # update the xla_args with the input with new sharding and retrace
           xla_model.xla_args = args
-          (xla_args_sharding_spec, args_and_ou_copy, graph_hash,
+          (xla_args_sharding_hash, args_and_ou_copy, graph_hash,
            arg_index_to_need_update_index, none_remover, graph_input_matcher,
-           dumb_return_handler,
-           xla_args_need_update) = extract_graph_helper(xla_model)
-          skip_checking_input_sharding_threashold = xu.getenv_as(
-              'XLA_DYNAMO_INPUT_SHARDING_CHECK_THRESHOLD', int, 5)
+           dumb_return_handler, xla_args_need_update,
+           tensor_arg_positions) = extract_graph_helper(xla_model)
+          skip_checking_input_sharding_threashold = input_sharding_check_threshold
         else:
           skip_checking_input_sharding_threashold -= 1
 
-    enter_ts = time.time()
     if len(args_and_out) == 0:
       return ()
 
     graph_input = graph_input_matcher(args)
-    start_ts = time.time()
     res = torch_xla._XLAC._run_cached_graph(graph_hash, graph_input)
     res = dumb_return_handler.addDumbReturn(args, res)
 
     assert len(res) == len(args_and_out), f"{len(res)} v.s. {len(args_and_out)}"
-    ncopy = 0
 
-    for arg_index, res_index in arg_index_to_need_update_index.items():
-      args[arg_index].copy_(res[res_index])
+    if arg_index_to_need_update_index:
+      torch_xla._XLAC._xla_batch_copy_(
+          [args[i] for i in arg_index_to_need_update_index.keys()],
+          [res[i] for i in arg_index_to_need_update_index.values()])
 
     # First few elements might be xla_args that needs to be in place updated
     result = res[len(xla_args_need_update):]
@@ -528,14 +599,13 @@ class UnsupportedNodesCollector(torch.fx.Interpreter):
     if len(fallback_ops) > 0:
       self._unsupported_nodes.append(n)
     else:
-      # Check whether the tensors contained in value are all XLA tensors.
-      def all_tensors_on_xla_device(value):
-        if isinstance(value, torch.Tensor):
-          return is_xla_tensor(value)
-        if isinstance(value, (list, tuple)):
-          return all(all_tensors_on_xla_device(v) for v in value)
-        # Not a tensor nor a container.
-        return True
+      # Check whether the tensors contained in values are all XLA tensors. The
+      # device check for all of them is done with a single pybind call.
+      def all_tensors_on_xla_device(values):
+        return torch_xla._XLAC._xla_all_tensors_on_xla_device([
+            leaf for leaf in pytree.tree_leaves(values)
+            if isinstance(leaf, torch.Tensor)
+        ])
 
       # Check whether the current node is supported or not.
       #
@@ -547,9 +617,7 @@ class UnsupportedNodesCollector(torch.fx.Interpreter):
       # - a node that whose tensor arguments are XLA tensors:
       #   avoids non-XLA tensors as FX graph arguments.
       args, kwargs = self.fetch_args_kwargs_from_env(n)
-      args_are_supported = all(
-          all_tensors_on_xla_device(v)
-          for v in itertools.chain(args, kwargs.values()))
+      args_are_supported = all_tensors_on_xla_device((args, kwargs))
 
       # If the current node is NOT supported, we add it to
       # the _unsupported_nodes list.
@@ -597,15 +665,110 @@ class XLAConstructorMoverPass(ConstructorMoverPass):
     return (device is not None and device.type == self.target)
 
 
+# Maximum number of entries kept in `_compiled_graph_cache`.
+_COMPILED_GRAPH_CACHE_SIZE = 128
+# Maps `_compiled_graph_cache_key` to a weak reference of the partitioned graph
+# returned by `extract_compiled_graph`, in least recently used order. The
+# partitioned graph owns the parameters, buffers and constants whose ids are in
+# the key, so the ids can not be reused while it is alive. The cache does not
+# keep it alive by itself, and its entry is dropped once it dies.
+_compiled_graph_cache = collections.OrderedDict()
+
+
+def clear_compiled_graph_cache():
+  """
+  Drops all of the graphs cached by `extract_compiled_graph`. Entries are also
+  evicted on their own once their graph is garbage collected, e.g. after
+  `torch._dynamo.reset()` releases it; call this to drop them right away.
+  """
+  _compiled_graph_cache.clear()
+
+
+def _compiled_graph_cache_key(xla_model: torch.fx.GraphModule, xla_args):
+  """
+  Returns a key identifying the compiled graph for `xla_model` and `xla_args`,
+  or None if the inputs can not be keyed.
+
+  Two calls share a key when the FX graphs have the same code, refer to the
+  same parameters, buffers and constants, and are called with tensors of the
+  same metadata (and sharding in SPMD mode) and equal non-tensor arguments.
+  Graphs calling into submodules are not keyed, as the submodules' state (e.g.
+  `training`) changes what they compute without changing the graph.
+  """
+  if any(node.op == 'call_module' for node in xla_model.graph.nodes):
+    return None
+
+  args_key = []
+  xla_tensor_args = []
+  for arg in xla_args:
+    if isinstance(arg, torch.Tensor):
+      args_key.append((arg.shape, arg.dtype, arg.device, arg.requires_grad))
+      if is_xla_tensor(arg):
+        xla_tensor_args.append(arg)
+    else:
+      try:
+        hash(arg)
+      except TypeError:
+        return None
+      args_key.append((type(arg), arg))
+
+  if xr.is_spmd():
+    sharding_key = torch_xla._XLAC._get_xla_sharding_specs_hash(xla_tensor_args)
+  else:
+    sharding_key = None
+
+  named_state = itertools.chain(xla_model.named_parameters(),
+                                xla_model.named_buffers())
+  state_key = tuple((name, id(value)) for name, value in named_state)
+  constants_key = tuple(
+      (node.target,
+       id(functools.reduce(getattr, node.target.split('.'), xla_model)))
+      for node in xla_model.graph.nodes
+      if node.op == 'get_attr')
+  return (xla_model.code, tuple(args_key), sharding_key, state_key,
+          constants_key)
+
+
 def extract_compiled_graph(xla_model: torch.fx.GraphModule, xla_args):
+  # Dynamo can hand over a graph identical to one that was already compiled,
+  # e.g. after a guard failure unrelated to the tensors. Reuse the previous
+  # result instead of rerunning the fallback op collection and partitioning.
+  cache_key = _compiled_graph_cache_key(xla_model, xla_args)
+  if cache_key is None:
+    return _extract_compiled_graph(xla_model, xla_args)
+
+  cached_ref = _compiled_graph_cache.get(cache_key)
+  partitioned_graph = cached_ref() if cached_ref is not None else None
+  if partitioned_graph is not None:
+    torch_xla._XLAC._xla_increment_counter('DynamoCompiledGraphCacheHit', 1)
+    _compiled_graph_cache.move_to_end(cache_key)
+    return partitioned_graph
+
+  partitioned_graph = _extract_compiled_graph(xla_model, xla_args)
+
+  def drop_dead_entry(ref):
+    if _compiled_graph_cache.get(cache_key) is ref:
+      del _compiled_graph_cache[cache_key]
+
+  _compiled_graph_cache[cache_key] = weakref.ref(partitioned_graph,
+                                                 drop_dead_entry)
+  _compiled_graph_cache.move_to_end(cache_key)
+  if len(_compiled_graph_cache) > _COMPILED_GRAPH_CACHE_SIZE:
+    _compiled_graph_cache.popitem(last=False)
+  return partitioned_graph
+
+
+def _extract_compiled_graph(xla_model: torch.fx.GraphModule, xla_args):
   if _args_on_cuda(xla_args):
     xla_args = tuple(_maybe_move_tensors_to_device(xla_args, xm.xla_device()))
 
   # Synchronize xla_args, so that each FunctionalTensorWrapper argument updates its
-  # value reference before actually computing it.
-  for a in xla_args:
-    if isinstance(a, torch.Tensor) and torch._is_functional_tensor(a):
-      torch._functionalize_sync(a)
+  # value reference before actually computing it. With functionalization
+  # disabled there are no FunctionalTensorWrapper arguments to synchronize.
+  if not functionalization_disabled:
+    for a in xla_args:
+      if isinstance(a, torch.Tensor) and torch._is_functional_tensor(a):
+        torch._functionalize_sync(a)
 
   # This call is critical to make sure xla_args' tensor id show up in graph_input_tensor_ids.
   # Don't reset the scope as we might be under some profiler trace scope.
@@ -657,8 +820,11 @@ def extract_compiled_graph(xla_model: torch.fx.GraphModule, xla_args):
   for i, need_update in enumerate(args_need_update_bool):
     if need_update and isinstance(all_xla_args[i], torch.Tensor):
       all_xla_args[i].copy_(cloned_args[i])
+  # Drop the clones so that they are not live tensors anymore when clearing the
+  # pending IRs below.
+  del cloned_args
 
-  torch_xla._XLAC._clear_pending_irs(str(xm.xla_device()))
+  torch_xla._XLAC._clear_pending_irs(torch_xla._XLAC._xla_get_default_device())
 
   class XlaOperatorSupport(torch.fx.passes.operator_support.OperatorSupport):
 
@@ -671,7 +837,16 @@ def extract_compiled_graph(xla_model: torch.fx.GraphModule, xla_args):
   supported_ops = XlaOperatorSupport()
   partitioner = CapabilityBasedPartitioner(
       xla_model, supported_ops, allows_single_node_partition=True)
-  partitions = partitioner.propose_partitions()
+  if len(unsupported_nodes) == 0:
+    # Every compute node is supported, so they all belong to a single partition
+    # and there is no need to run the partitioner's merge loop.
+    compute_nodes = [
+        node for node in xla_model.graph.nodes
+        if supported_ops.is_node_supported(None, node)
+    ]
+    partitions = [Partition(id=0, nodes=compute_nodes)] if compute_nodes else []
+  else:
+    partitions = partitioner.propose_partitions()
 
   # propose_partitions() does not guarantee topolgical order, so sort it manually
   for partition in partitions:
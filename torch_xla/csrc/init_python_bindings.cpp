@@ -1271,6 +1271,23 @@ void InitXlaModuleBindings(py::module m) {
         [](const at::Tensor& tensor) { return GetTensorViewAliasId(tensor); });
   m.def("_xla_get_tensor_id",
         [](const at::Tensor& tensor) { return GetTensorId(tensor); });
+  m.def("_xla_all_tensors_on_xla_device",
+        [](const std::vector<at::Tensor>& tensors) -> bool {
+          for (const at::Tensor& tensor : tensors) {
+            if (tensor.device().type() != at::kXLA) {
+              return false;
+            }
+          }
+          return true;
+        });
+  m.def("_xla_get_tensor_ids", [](const std::vector<at::Tensor>& tensors) {
+    std::vector<std::ptrdiff_t> tensor_ids;
+    tensor_ids.reserve(tensors.size());
+    for (const at::Tensor& tensor : tensors) {
+      tensor_ids.push_back(GetTensorId(tensor));
+    }
+    return tensor_ids;
+  });
   m.def("_xla_set_auto_sharding", []() {
     ShardingUtil::SetAutoSharding();
     XLA_CHECK(ShardingUtil::GetAutoSharding());
@@ -1739,6 +1756,16 @@ void InitXlaModuleBindings(py::module m) {
       },
       py::arg("tensors"), py::arg("devices"), py::arg("wait") = true,
       py::arg("sync_xla_data") = true);
+  // Copies srcs[i] into dests[i] in place for every i. The copies go through
+  // the dispatcher like `Tensor.copy_`, this only saves the per-tensor Python
+  // roundtrip.
+  m.def("_xla_batch_copy_", [](std::vector<at::Tensor>& dests,
+                               const std::vector<at::Tensor>& srcs) {
+    XLA_CHECK_EQ(dests.size(), srcs.size());
+    for (size_t i = 0; i < dests.size(); ++i) {
+      dests[i].copy_(srcs[i]);
+    }
+  });
   m.def(
       "_xla_warm_up_cache",
       [](const std::vector<at::Tensor>& tensors,
@@ -2113,6 +2140,24 @@ void InitXlaModuleBindings(py::module m) {
           }
           return sharding_specs;
         });
+  // Returns a hash of the sharding specs of `tensors`. This is cheaper than
+  // `_get_xla_sharding_specs` for callers that only need to detect whether the
+  // shardings changed, since no Python strings are materialized.
+  m.def("_get_xla_sharding_specs_hash",
+        [](const std::vector<at::Tensor>& tensors) -> py::bytes {
+          tsl::profiler::TraceMe activity("_get_xla_sharding_specs_hash",
+                                          tsl::profiler::TraceMeLevel::kInfo);
+          TORCH_LAZY_TIMED("_get_xla_sharding_specs_hash");
+          torch::lazy::hash_t hash =
+              torch::lazy::Hash(static_cast<int64_t>(tensors.size()));
+          for (const at::Tensor& tensor : tensors) {
+            hash = torch::lazy::HashCombine(
+                hash, torch::lazy::Hash(
+                          GetXLAShardingSpec(bridge::GetXlaTensor(tensor))));
+          }
+          std::string bin((const char*)&hash, sizeof(hash));
+          return py::bytes(bin);
+        });
   m.def("_get_xla_sharding_type",
         [](const at::Tensor& input) -> std::optional<int> {
           XLATensorPtr xtensor = bridge::GetXlaTensor(input);
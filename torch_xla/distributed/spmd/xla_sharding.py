@@ -1,6 +1,7 @@
+import math
 import os
-from collections import OrderedDict, defaultdict
-from dataclasses import dataclass, field
+from collections import OrderedDict
+from dataclasses import dataclass
 import torch
 import torch_xla
 import torch_xla.core.xla_model as xm
@@ -51,29 +52,31 @@ class Mesh:
                device_ids: Union[np.ndarray, List],
                mesh_shape: Tuple[int, ...],
                axis_names: Tuple[str, ...] = None):
-    if not isinstance(device_ids, np.ndarray):
-      device_ids = np.array(device_ids)
+    device_ids = np.asarray(device_ids)
     assert (axis_names is None) or (len(mesh_shape) == len(axis_names))
     assert axis_names is None or (len(set(axis_names)) == len(axis_names))
-    assert (len(device_ids) == np.prod(mesh_shape))
-    assert len(device_ids) == len(np.unique(device_ids))
+    assert (len(device_ids) == math.prod(mesh_shape))
+    assert len(device_ids) == len(set(device_ids.tolist()))
     self.device_ids = device_ids
     self.mesh_shape = mesh_shape
     self.axis_names = axis_names
-    assert all(d < self.size() for d in device_ids)
+    assert (device_ids < self.size()).all()
+    # The logical mesh is queried on every sharding annotation, so build it
+    # once. It is a read-only view shared by all callers.
+    self._logical_mesh = device_ids.reshape(mesh_shape)
+    self._logical_mesh.setflags(write=False)
+    # Unnamed mesh axes are keyed by their index.
+    names = range(len(mesh_shape)) if axis_names is None else axis_names
+    self._shape = OrderedDict(zip(names, mesh_shape))
 
   def size(self):
-    return np.prod(self.mesh_shape)
+    return math.prod(self.mesh_shape)
 
   def shape(self):
-    if self.axis_names is None:
-      return OrderedDict(
-          (dim, size) for dim, size in enumerate(self.mesh_shape))
-    return OrderedDict(
-        (name, size) for name, size in zip(self.axis_names, self.mesh_shape))
+    return OrderedDict(self._shape)
 
   def get_logical_mesh(self):
-    return self.device_ids.reshape(self.mesh_shape)
+    return self._logical_mesh
 
   def get_axis_name_idx(self, name: str) -> int:
     if name not in self.axis_names:
@@ -83,11 +86,14 @@ class Mesh:
   @functools.lru_cache(maxsize=None)
   def _get_op_sharding_args(self, partition_spec: Tuple):
     partition_spec = _translate_named_partition_spec(self, partition_spec)
-    flat_specs = np.hstack([d for d in partition_spec])
-    specs = [d for d in flat_specs if d is not None]
-    assert all(d >= 0 and d < len(self.mesh_shape) for d in specs), \
+    # Flatten the mesh axes in the partition spec, including the grouped ones.
+    specs = [
+        d for p in partition_spec for d in (p if type(p) is tuple else (p,))
+        if d is not None
+    ]
+    assert all(0 <= d < len(self.mesh_shape) for d in specs), \
       f"partition_spec ({partition_spec}) contains out of bound index into mesh_shape."
-    assert len(specs) == len(np.unique(specs)), \
+    assert len(specs) == len(set(specs)), \
     f"Each device mesh dimension should appear at most once in partition_spec {partition_spec}."
 
     tile_assignment = _get_tile_assignment(self, partition_spec)
@@ -116,6 +122,11 @@ class Mesh:
     # in mark_sharding API.
     if len(partition_spec) == 0:
       return torch_xla._XLAC.OpSharding([], [], [], ShardingType.REPLICATED)
+    # Fully replicated specs don't need the tile assignment. Specs of a lower
+    # rank than the mesh are partially replicated, see `_get_op_sharding_args`.
+    if len(partition_spec) >= len(self.mesh_shape) and all(
+        d is None for d in partition_spec):
+      return torch_xla._XLAC.OpSharding([], [], [], ShardingType.REPLICATED)
 
     tile_assignment, group_assignment, replication_groups, sharding_type = self._get_op_sharding_args(
         partition_spec)
@@ -171,22 +182,27 @@ class HybridMesh(Mesh):
     self.device_attributes = xr.global_runtime_device_attributes()
     self.device_attributes.sort(
         key=lambda attr: xm.parse_xla_device(attr['name'])[1])
-
-    if 'slice_index' in self.device_attributes[0] and np.prod(
-        dcn_mesh_shape) == 1:
+    # Physical coords of each device, indexed by its ordinal. Only TPU devices
+    # report them, see `_get_physical_tpu_mesh`.
+    self._device_coords = None
+    if 'coords' in self.device_attributes[0]:
+      self._device_coords = np.array(
+          [attr['coords'] for attr in self.device_attributes], dtype=int)
+
+    dcn_size = math.prod(dcn_mesh_shape)
+    is_multislice = 'slice_index' in self.device_attributes[0]
+    if is_multislice and dcn_size == 1:
       raise ValueError('Provide dcn_mesh_shape to create a mesh for multislice')
-    if 'slice_index' not in self.device_attributes[0] and np.prod(
-        dcn_mesh_shape) > 1:
+    if not is_multislice and dcn_size > 1:
       raise ValueError('Invalid dcn_mesh_shape for single slice mesh')
     self.ici_mesh_shape = ici_mesh_shape
     self.dcn_mesh_shape = dcn_mesh_shape
-    if np.prod(dcn_mesh_shape) > 1 and 'slice_index' in self.device_attributes[
-        0]:  # multislice
+    if is_multislice and dcn_size > 1:
       mesh = self._create_hybrid_device_mesh(self.ici_mesh_shape,
                                              self.dcn_mesh_shape)
     else:
       mesh = self._create_device_mesh(self.ici_mesh_shape)
-    device_ids = mesh.flatten()
+    device_ids = mesh.ravel()
     super().__init__(device_ids, mesh_shape, axis_names)
 
   # This is imported from JAX: https://github.com/google/jax/blob/main/jax/experimental/mesh_utils.py#L172
@@ -202,11 +218,11 @@ class HybridMesh(Mesh):
     """
     assert xm.xla_device_hw(xm.xla_device()) == 'TPU'
     # coords is a 3-dims tuple representing the device in physical mesh
-    device_coords = [self.device_attributes[d]['coords'] for d in devices]
-    dims = tuple(d + 1 for d in max(device_coords))
+    device_coords = self._device_coords[devices]
+    dims = tuple(device_coords.max(axis=0) + 1)
     out = np.empty(dims, dtype=int)
-    for coords, d in zip(device_coords, devices):
-      out[coords[0], coords[1], coords[2]] = d
+    # Scatter all devices into the physical mesh at once.
+    out[tuple(device_coords.T)] = devices
     return out
 
   # This is imported from JAX: https://github.com/google/jax/blob/main/jax/experimental/mesh_utils.py#L64.
@@ -259,29 +275,29 @@ class HybridMesh(Mesh):
     # Assign logical axes from highest network intensity to lowest.
     # `mesh_shape` is assumed to ordered by lowest network intensity first, so
     # reverse it first.
+    # Candidate combinations of physical axes to map to a logical axis, tried
+    # from the most to the fewest axes. They only depend on the physical mesh
+    # rank, so enumerate them once for all logical axes.
+    candidate_indices = [
+        c_indices for num_axes in range(3, 0, -1)
+        for c_indices in itertools.combinations(
+            range(len(assignable_physical_mesh)), num_axes)
+    ]
     # Assigns devices to 2D or 3D logical mesh.
     for logical_axis_index, logical_axis_size in reversed(
         list(enumerate(mesh_shape))):
-      for num_axes in range(3, 0, -1):
-        # map a combination of devices in physical axes to the logical axis.
-        axes = itertools.combinations(assignable_physical_mesh, num_axes)
-        indices = itertools.combinations(
-            range(len(assignable_physical_mesh)), num_axes)
-        for c_axes, c_indices in zip(axes, indices):
-          if np.product(c_axes) == logical_axis_size:
-            assignment[logical_axis_index] = c_indices
-            # Zero the assigned physical axes.
-            assignable_physical_mesh = [
-                0 if i in c_indices else v
-                for i, v in enumerate(assignable_physical_mesh)
-            ]
-            break
-        if assignment[logical_axis_index]:
-          # We already found an assignment from one candidate above.
+      for c_indices in candidate_indices:
+        # Assigned physical axes are zeroed, so they never match again.
+        if math.prod(assignable_physical_mesh[i]
+                     for i in c_indices) == logical_axis_size:
+          assignment[logical_axis_index] = c_indices
+          # Zero the assigned physical axes.
+          for i in c_indices:
+            assignable_physical_mesh[i] = 0
           break
       else:
-        # If the num_axes for loop did not break, i.e. none of the candidates work
-        # goto here with this while-else construct.
+        # If the candidates for loop did not break, i.e. none of the candidates
+        # work goto here with this for-else construct.
         if logical_axis_size > 1:
           raise NotImplementedError(
               'Failed to find assignment for logical_axis_index'
@@ -315,7 +331,7 @@ class HybridMesh(Mesh):
 
     if devices is None:
       devices = np.arange(xr.global_runtime_device_count())
-    if np.prod(mesh_shape) != len(devices):
+    if math.prod(mesh_shape) != len(devices):
       raise ValueError(
           f'Number of devices {len(devices)} must equal the product '
           f'of mesh_shape {mesh_shape}')
@@ -341,12 +357,14 @@ class HybridMesh(Mesh):
         A np.ndarray of device logical ordinal with ici_mesh_shape * dcn_mesh_shape as its shape
         that can be fed into HybridMesh for hybrid parallelism.
     """
-    granule_dict = defaultdict(list)
-    for d, dev in enumerate(self.device_attributes):
-      granule_dict[dev['slice_index']].append(d)
-    # sorts devices based on slice_index.
-    granules = list(granule_dict[key] for key in sorted(granule_dict.keys()))
-    if np.prod(dcn_mesh_shape) != len(granules):
+    slice_index = np.array(
+        [attr['slice_index'] for attr in self.device_attributes])
+    # sorts devices based on slice_index, keeping the ordinal order within each
+    # slice, and splits them where the slice_index changes.
+    devices = np.argsort(slice_index, kind='stable')
+    granules = np.split(devices,
+                        np.flatnonzero(np.diff(slice_index[devices])) + 1)
+    if math.prod(dcn_mesh_shape) != len(granules):
       raise ValueError(
           f'Number of slices {len(granules)} must equal the product of '
           f'dcn_mesh_shape {dcn_mesh_shape}')
@@ -355,12 +373,15 @@ class HybridMesh(Mesh):
         self._create_device_mesh(ici_mesh_shape, granule)
         for granule in granules
     ]
-    granule_mesh = np.arange(len(granules)).reshape(dcn_mesh_shape)
-    blocks = np.vectorize(
-        lambda i: per_granule_meshes[i], otypes=[object])(
-            granule_mesh)
-    device_mesh = np.block(blocks.tolist())
-    return device_mesh
+    # All per-slice meshes share ici_mesh_shape, so lay them out over the DCN
+    # mesh by stacking them and interleaving each DCN axis with its ICI axis.
+    num_axes = len(ici_mesh_shape)
+    device_mesh = np.stack(per_granule_meshes).reshape(
+        tuple(dcn_mesh_shape) + tuple(ici_mesh_shape))
+    device_mesh = device_mesh.transpose(
+        [axis for i in range(num_axes) for axis in (i, num_axes + i)])
+    return device_mesh.reshape(
+        tuple(x * y for x, y in zip(dcn_mesh_shape, ici_mesh_shape)))
 
 
 class ShardingType(IntEnum):
@@ -401,7 +422,7 @@ def _get_tile_assignment(
   # mesh for permutation.
   tiled_dims = [x for x in partition_spec if x is not None]
   permutation = np.hstack(tiled_dims).tolist() if tiled_dims else []
-  missing_axes = sorted(set(range(len(mesh.shape()))) - set(permutation))
+  missing_axes = sorted(set(range(len(mesh.mesh_shape))) - set(permutation))
   tile_assignment = mesh.get_logical_mesh().transpose(permutation +
                                                       missing_axes)
 
@@ -434,22 +455,18 @@ def _get_group_assignment(sharding_type: ShardingType,
     # will be used to group replication devices.
     tile_shape = tile_assignment.shape
     # When creating the tile assignment, the mesh is permuted so that the first
-    # few axes are used for tiling.
-    tile_dims = range(tensor_rank - len(replicate_dims))
-    group_list = [tile_assignment]
-    for d in tile_dims:
-      _group_list = list()
-      for group_members in group_list:
-        _group_list += np.split(group_members, tile_shape[d], d)
-      group_list = _group_list
-    replication_groups = [group.flatten().tolist() for group in group_list]
+    # few axes are used for tiling. Each group spans the remaining replicated
+    # axes, i.e. a row of the tile assignment with the tiled axes flattened.
+    num_tile_dims = tensor_rank - len(replicate_dims)
+    num_groups = math.prod(tile_shape[:num_tile_dims])
+    replication_groups = tile_assignment.reshape(num_groups, -1).tolist()
 
     mesh_axis = itertools.count()
     group_tile_shape = [
         1 if d in replicate_dims else tile_shape[next(mesh_axis)]
         for d in range(tensor_rank)
     ]
-    group_assignment = np.arange(len(replication_groups)).reshape(
+    group_assignment = np.arange(num_groups).reshape(
         tuple(group_tile_shape)).tolist()
   return group_assignment, replication_groups
 
@@ -625,24 +642,15 @@ class ShardingSpec:
   partition_spec: Tuple[Union[int, None]]
   minibatch: Optional[bool] = False
 
-  # Derived fields
-  _tile_assignment: List[int] = field(init=False)
-  _group_assignment: List[int] = field(init=False)
-  _replication_groups: List[int] = field(init=False)
-  _sharding_type: ShardingType = field(init=False)
-
-  @xr.requires_pjrt
-  def __post_init__(self):
-    mesh = self.mesh
-    partition_spec = _translate_named_partition_spec(mesh, self.partition_spec)
-    tile_assignment = _get_tile_assignment(mesh, partition_spec)
-    self._tile_assignment = tile_assignment.tolist()
-    self._sharding_type = _get_sharding_type(partition_spec,
-                                             xr.global_runtime_device_count())
-    replicate_dims = {i for i, d in enumerate(partition_spec) if d is None}
-    self._group_assignment, self._replication_groups = _get_group_assignment(
-        self._sharding_type, tile_assignment, len(partition_spec),
-        replicate_dims)
+  @functools.cached_property
+  def _sharding_args(self) -> Tuple[List, List, List, int]:
+    # Derived on first use, so only specs that get applied pay for them. The
+    # args are cached on the mesh and shared by specs with the same partition.
+
+    # For scalar tensors, it can only be replicated.
+    if len(self.partition_spec) == 0:
+      return [], [], [], int(ShardingType.REPLICATED)
+    return self.mesh._get_op_sharding_args(self.partition_spec)
 
   def xla_spec(self, t: torch.Tensor) -> Union['XlaShardingSpec', None]:
     """
@@ -651,10 +659,7 @@ class ShardingSpec:
     """
     if not self.can_apply(t):
       return None
-    return torch_xla._XLAC.XlaShardingSpec(t, self._tile_assignment,
-                                           self._group_assignment,
-                                           self._replication_groups,
-                                           int(self._sharding_type),
+    return torch_xla._XLAC.XlaShardingSpec(t, *self._sharding_args,
                                            self.minibatch)
 
   def can_apply(self, t: torch.Tensor) -> bool:
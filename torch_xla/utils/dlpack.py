@@ -1,8 +1,20 @@
-from typing import Any
+from typing import Any, Dict
 import enum
 from torch.utils.dlpack import DLDeviceType
 import torch_xla
 
+# The external ready-event stream of a CUDA device does not change during the
+# lifetime of the runtime client, so it is only queried once per device id.
+_CUDA_STREAM_CACHE: Dict[int, int] = {}
+
+
+def _get_stream_for_cuda_device(device_id: int) -> int:
+  stream = _CUDA_STREAM_CACHE.get(device_id, None)
+  if stream is None:
+    stream = torch_xla._XLAC._get_stream_for_cuda_device(device_id)
+    _CUDA_STREAM_CACHE[device_id] = stream
+  return stream
+
 
 def to_dlpack(xla_tensor: Any):
   return torch_xla._XLAC._to_dlpack(xla_tensor)
@@ -13,7 +25,7 @@ def from_dlpack(ext_tensor: Any):
       ext_tensor, '__dlpack__'):
     device_type, device_id = ext_tensor.__dlpack_device__()
     if device_type == DLDeviceType.kDLGPU:
-      stream = torch_xla._XLAC._get_stream_for_cuda_device(device_id)
+      stream = _get_stream_for_cuda_device(device_id)
       dlpack = ext_tensor.__dlpack__(stream=stream)
     else:
       dlpack = ext_tensor.__dlpack__()